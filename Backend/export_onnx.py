@@ -0,0 +1,61 @@
+"""
+Export Real-ESRGAN (RealESRGAN_x4plus) to ONNX for app.py.
+
+Run once from this folder after putting the .pth weights in ./weights:
+    python export_onnx.py
+
+Writes weights/realesrgan.onnx with dynamic batch / height / width, so the
+batched 256x256 tiles from run_realesrgan (and any other size) can be fed
+to the same session. On a CUDA host it also writes an fp16 graph,
+weights/realesrgan_fp16.onnx, which is what app.py serves on the GPU.
+app.py picks the files up automatically when onnxruntime is installed.
+"""
+import torch
+
+# Importing app applies the torchvision compatibility patch basicsr needs
+from app import REAL_ESRGAN_ONNX, REAL_ESRGAN_ONNX_FP16, REAL_ESRGAN_WEIGHTS, TILE_SIZE
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+
+def export_graph(model, dummy, path):
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy,
+            path,
+            opset_version=17,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={
+                "input": {0: "B", 2: "H", 3: "W"},
+                "output": {0: "B", 2: "H", 3: "W"},
+            },
+        )
+    print("[PixelLift] Exported Real-ESRGAN to", path)
+
+
+def export():
+    model = RRDBNet(
+        num_in_ch=3,
+        num_out_ch=3,
+        num_feat=64,
+        num_block=23,
+        num_grow_ch=32,
+        scale=4,
+    )
+    loadnet = torch.load(REAL_ESRGAN_WEIGHTS, map_location="cpu")
+    keyname = "params_ema" if "params_ema" in loadnet else "params"
+    model.load_state_dict(loadnet[keyname], strict=True)
+    model.eval()
+
+    dummy = torch.rand(1, 3, TILE_SIZE, TILE_SIZE)
+    export_graph(model, dummy, REAL_ESRGAN_ONNX)
+
+    # Half-precision conv kernels aren't available on every CPU, so the fp16
+    # graph is traced on the GPU it will run on.
+    if torch.cuda.is_available():
+        export_graph(model.cuda().half(), dummy.cuda().half(), REAL_ESRGAN_ONNX_FP16)
+
+
+if __name__ == "__main__":
+    export()
@@ -47,6 +47,7 @@ export default function App() {
   const [dimensions, setDimensions] = useState<{ width: number; height: number }>({ width: 0, height: 0 });
   
   const [resultSummary, setResultSummary] = useState<string>("");
+  const [resultType, setResultType] = useState<string>("");
 
   // Handle File Upload
   const handleFileSelect = (selectedFile: File) => {
@@ -71,6 +72,12 @@ export default function App() {
     };
   }, [previewUrl]);
 
+  useEffect(() => {
+    return () => {
+      if (resultUrl) URL.revokeObjectURL(resultUrl);
+    };
+  }, [resultUrl]);
+
   const handleStartEnhancement = async () => {
   // If no file is loaded, do nothing
   if (!file || !previewUrl) {
@@ -98,17 +105,14 @@ export default function App() {
       throw new Error("Server error");
     }
 
-    // Backend returns JSON: { image_data, width, height, summary }
-    const data = await resp.json() as {
-      image_data: string;
-      width: number;
-      height: number;
-      summary: string;
-    };
+    // Backend returns the image bytes; metadata comes in X-* headers
+    const blob = await resp.blob();
+    const summary = decodeURIComponent(resp.headers.get("X-Summary") || "");
 
     // Save enhanced image URL and summary
-    setResultUrl(data.image_data);          // data:image/png;base64,....
-    setResultSummary(data.summary || "");
+    setResultUrl(URL.createObjectURL(blob));   // blob:... (webp / png)
+    setResultSummary(summary);
+    setResultType(blob.type);
     // if you track dimensions somewhere, you can set them too
 
     // Move to Result screen
@@ -234,6 +238,7 @@ export default function App() {
                   <ResultView 
                     originalUrl={previewUrl}
                     enhancedUrl={resultUrl}
+                    enhancedType={resultType}
                     mode={mode}
                     strength={strength}
                     onReset={handleReset}
@@ -7,6 +7,7 @@ import { EnhancementMode } from "./ConfigurationPanel";
 interface ResultViewProps {
   originalUrl: string;
   enhancedUrl: string;
+  enhancedType?: string;
   mode: EnhancementMode;
   strength: number;
   onReset: () => void;
@@ -29,9 +30,16 @@ const MODE_FILTERS: Record<EnhancementMode, React.CSSProperties> = {
   "product-clarity": { filter: "brightness(1.05) contrast(1.1)" },
 };
 
+const FILE_EXTENSIONS: Record<string, string> = {
+  "image/png": "png",
+  "image/jpeg": "jpg",
+  "image/webp": "webp",
+};
+
 export const ResultView: React.FC<ResultViewProps> = ({
   originalUrl,
   enhancedUrl,
+  enhancedType,
   mode,
   strength,
   onReset,
@@ -64,8 +72,11 @@ export const ResultView: React.FC<ResultViewProps> = ({
     if (!enhancedUrl) return; // nothing to download yet
 
     const link = document.createElement("a");
-    link.href = enhancedUrl; // data URL from backend
-    link.download = "PixelLift-enhanced.png";
+    link.href = enhancedUrl; // blob URL from backend
+    // Backend sends PNG for documents (and outputs too large for WebP),
+    // JPEG when asked for it, WebP for everything else
+    const ext = FILE_EXTENSIONS[enhancedType ?? ""] ?? (mode === "document-ocr" ? "png" : "webp");
+    link.download = `PixelLift-enhanced.${ext}`;
     document.body.appendChild(link);
     link.click();
     link.remove();